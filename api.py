@@ -2,14 +2,25 @@
 # api.py - EduPath Admin
 # ======================
 from fastapi import FastAPI, UploadFile, Form
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import shutil, os
+from starlette.concurrency import run_in_threadpool
+import os, sqlite3
+import aiofiles
+from contextlib import asynccontextmanager, closing
+from uuid import uuid4
 from pathlib import Path
 import edupath  # your main allocation logic
 import uvicorn
 
-app = FastAPI(title="EduPath Admin")
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # uvicorn re-raises SIGTERM after shutdown, so atexit never runs; stop PDF workers explicitly
+    await run_in_threadpool(edupath.shutdown_render_pool)
+
+app = FastAPI(title="EduPath Admin", lifespan=lifespan)
 
 # Allow cross-origin for frontend testing/demo
 app.add_middleware(
@@ -26,14 +37,106 @@ UPLOAD_DIR = BASE_DIR / "uploads"
 REPORT_DIR = BASE_DIR / "reports"
 PDF_DIR = BASE_DIR / "pdfs"
 UNI_JSON = BASE_DIR / "universities.json"
+OVERRIDES_DB = BASE_DIR / "overrides.db"
+FULL_PDF = PDF_DIR / "allocations_full.pdf"
+
+# Write uploads to disk in 1 MiB chunks
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 # Ensure directories exist
 UPLOAD_DIR.mkdir(exist_ok=True)
 REPORT_DIR.mkdir(exist_ok=True)
 PDF_DIR.mkdir(exist_ok=True)
 
-# Store manual overrides in memory
-overrides = {}
+# Serve generated PDFs directly once they exist
+app.mount("/pdfs", StaticFiles(directory=PDF_DIR), name="pdfs")
+
+# ======================
+# Shared state across uvicorn workers
+# ======================
+class OverrideStore:
+    """
+    Manual overrides and the latest upload path, kept in SQLite so every worker sees them.
+    Overrides belong to the latest upload and are cleared when a new one is recorded.
+    Each write bumps a version number so workers know when their cached allocations are stale.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS overrides (student_id TEXT PRIMARY KEY, university TEXT, course TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO state VALUES ('version', '0')")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, isolation_level=None)
+
+    def _write(self, *statements):
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.execute("UPDATE state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+            version = int(conn.execute("SELECT value FROM state WHERE key = 'version'").fetchone()[0])
+            conn.execute("COMMIT")
+        return version
+
+    def _get_state(self, key):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_all(self):
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT student_id, university, course FROM overrides").fetchall()
+        return {sid: {"university": uni, "course": course} for sid, uni, course in rows}
+
+    def set(self, student_id, university, course):
+        return self._write(("INSERT OR REPLACE INTO overrides VALUES (?, ?, ?)", (student_id, university, course)))
+
+    def set_latest_upload(self, path):
+        # A new upload is a new cohort, so overrides made against the previous one no longer apply
+        return self._write(
+            ("DELETE FROM overrides", ()),
+            ("INSERT OR REPLACE INTO state VALUES ('latest_upload', ?)", (str(path),)),
+        )
+
+    def latest_upload(self):
+        path = self._get_state("latest_upload")
+        return Path(path) if path else None
+
+    def version(self):
+        return int(self._get_state("version"))
+
+store = OverrideStore(OVERRIDES_DB)
+
+# Last allocation result in this worker, patched in place by manual overrides
+app.state.df_alloc = None
+app.state.alloc_version = None
+
+async def current_allocations():
+    """
+    Return the cached allocations, re-allocating from the latest upload if the store has changed
+    """
+    version = await run_in_threadpool(store.version)
+    if app.state.alloc_version != version:
+        latest_upload = await run_in_threadpool(store.latest_upload)
+        if latest_upload is None:
+            app.state.df_alloc = None
+        else:
+            overrides = await run_in_threadpool(store.get_all)
+            app.state.df_alloc = await run_in_threadpool(edupath.allocate, latest_upload, uni_json_path=UNI_JSON, overrides=overrides)
+        app.state.alloc_version = version
+    return app.state.df_alloc
+
+# ======================
+# Store busy (another worker holds the SQLite write lock past the busy timeout)
+# ======================
+@app.exception_handler(sqlite3.OperationalError)
+async def store_error(request, exc):
+    if "locked" in str(exc):
+        return HTMLResponse("<h3>Server is busy saving another change. Please try again.</h3>", status_code=503)
+    return HTMLResponse("<h3>Could not access the overrides database.</h3>", status_code=500)
 
 # ======================
 # Serve index.html
@@ -50,19 +153,37 @@ async def get_index():
 # ======================
 @app.post("/allocate", response_class=HTMLResponse)
 async def allocate(file: UploadFile):
-    # Save uploaded Excel
+    # Save uploaded Excel under a pending name, so a bad upload can't replace a good file of the same name
     excel_path = UPLOAD_DIR / file.filename
-    with open(excel_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    pending_path = excel_path.with_name(f".pending-{uuid4().hex}-{excel_path.name}")
+    async with aiofiles.open(pending_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await out.write(chunk)
+
+    synced_version = await run_in_threadpool(store.version)
 
-    # Call allocation logic
-    df_alloc = edupath.allocate(excel_path, uni_json_path=UNI_JSON, overrides=overrides)
+    # Call allocation logic (blocking work runs off the event loop); a new upload starts without overrides
+    try:
+        df_alloc = await run_in_threadpool(edupath.allocate, pending_path, uni_json_path=UNI_JSON)
+    except Exception as exc:
+        pending_path.unlink(missing_ok=True)
+        return HTMLResponse(f"<h3>Could not allocate from {file.filename}: {exc}</h3>", status_code=400)
+
+    # Only a file that allocated successfully becomes the latest upload (this also clears old overrides)
+    os.replace(pending_path, excel_path)
+    version = await run_in_threadpool(store.set_latest_upload, excel_path)
+    app.state.df_alloc = df_alloc
+    # The result is current unless another worker wrote an override while we were allocating
+    app.state.alloc_version = version if version == synced_version + 1 else None
+
+    # Full allocations PDF is now stale
+    FULL_PDF.unlink(missing_ok=True)
 
     # Generate per-student reports (HTML & PDF)
-    edupath.generate_reports(df_alloc, REPORT_DIR, PDF_DIR)
+    await run_in_threadpool(edupath.generate_reports, df_alloc, REPORT_DIR, PDF_DIR)
 
     # Return updated allocations table HTML
-    html_table = edupath.generate_allocations_table(df_alloc)
+    html_table = await run_in_threadpool(edupath.generate_allocations_table, df_alloc)
     return HTMLResponse(html_table)
 
 # ======================
@@ -74,14 +195,28 @@ async def apply_override(
     university: str = Form(...),
     course: str = Form(...)
 ):
+    df_alloc = await current_allocations()
+    if df_alloc is None:
+        return HTMLResponse("<h3>No allocations yet. Upload an Excel file first.</h3>", status_code=404)
+    synced_version = app.state.alloc_version
+
     # Save override
-    overrides[student_id] = {"university": university, "course": course}
+    version = await run_in_threadpool(store.set, student_id, university, course)
+
+    # Patch only the overridden student and regenerate their report
+    mask = df_alloc["Student ID"] == student_id
+    if mask.any():
+        df_alloc.loc[mask, ["Allocated University", "Allocated Course", "Reasoning"]] = [university, course, "Manual override applied"]
+        await run_in_threadpool(edupath.generate_report, df_alloc.loc[mask].iloc[0], REPORT_DIR, PDF_DIR)
+
+    # The patched cache is current unless another worker wrote in the meantime
+    if version == synced_version + 1:
+        app.state.alloc_version = version
+
+    # Full allocations PDF is now stale
+    FULL_PDF.unlink(missing_ok=True)
 
-    # Re-run allocation to apply override
-    latest_file = max(UPLOAD_DIR.glob("*.xlsx"), key=os.path.getctime)
-    df_alloc = edupath.allocate(latest_file, uni_json_path=UNI_JSON, overrides=overrides)
-    edupath.generate_reports(df_alloc, REPORT_DIR, PDF_DIR)
-    html_table = edupath.generate_allocations_table(df_alloc)
+    html_table = await run_in_threadpool(edupath.generate_allocations_table, df_alloc)
     return HTMLResponse(html_table)
 
 # ======================
@@ -99,18 +234,32 @@ async def download_student_pdf(student_id: str):
 # ======================
 @app.get("/download_full_pdf")
 async def download_full_pdf():
-    pdf_path = PDF_DIR / "allocations_full.pdf"
     # Generate full allocations PDF if not exists
-    if not pdf_path.exists():
-        # Find latest Excel
-        latest_file = max(UPLOAD_DIR.glob("*.xlsx"), key=os.path.getctime)
-        df_alloc = edupath.allocate(latest_file, uni_json_path=UNI_JSON, overrides=overrides)
-        edupath.generate_full_pdf(df_alloc, pdf_path)
-    return FileResponse(pdf_path, filename="allocations_full.pdf")
+    if not FULL_PDF.exists():
+        df_alloc = await current_allocations()
+        if df_alloc is None:
+            return HTMLResponse("<h3>No allocations yet. Upload an Excel file first.</h3>", status_code=404)
+        await run_in_threadpool(edupath.generate_full_pdf, df_alloc, FULL_PDF)
+    # Version the URL so browsers never serve a cached copy of an older PDF
+    return RedirectResponse(f"/pdfs/{FULL_PDF.name}?v={FULL_PDF.stat().st_mtime_ns}")
 
 # ======================
 # Run server
 # ======================
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))  # use Render's PORT
-    uvicorn.run("api:app", host="0.0.0.0", port=port, reload=False)
+    if os.environ.get("EDUPATH_DEV") == "1":
+        # Development: auto-reload on code changes, single worker
+        uvicorn.run("api:app", host="0.0.0.0", port=port, reload=True)
+    else:
+        uvicorn.run(
+            "api:app",
+            host="0.0.0.0",
+            port=port,
+            # WEB_CONCURRENCY (set by Render) caps workers to the instance's share of the host CPUs
+            workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count())),
+            # auto picks uvloop and httptools when installed (uvicorn[standard] skips uvloop on Windows)
+            loop="auto",
+            http="auto",
+            log_level="warning",
+        )
@@ -2,10 +2,22 @@
 # edupath.py - EduPath Allocation Logic
 # ======================
 import pandas as pd
+import numpy as np
+import io
 import json
+import math
+import multiprocessing
+import os
+import threading
+from functools import lru_cache
 from pathlib import Path
-from weasyprint import HTML
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+from jinja2 import Template
+from pypdf import PdfWriter
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ----------------------
 # Grade mapping for score calculation
@@ -19,6 +31,83 @@ GRADE_TO_SCORE = {
     "F": 0
 }
 
+# Categorical dtype whose codes equal the grade scores (F=0 ... A=5, unknown=-1)
+GRADE_DTYPE = pd.CategoricalDtype(sorted(GRADE_TO_SCORE, key=GRADE_TO_SCORE.get), ordered=True)
+
+# ----------------------
+# WeasyPrint font configuration and stylesheet, reused within each thread
+# ----------------------
+# A FontConfiguration wraps one Pango font map, which is not safe to share between
+# the server's threadpool threads, so each thread builds and keeps its own
+_render_local = threading.local()
+
+def render_resources():
+    """
+    Return this thread's (FontConfiguration, full allocations CSS), creating them on first use
+    """
+    if not hasattr(_render_local, "font_config"):
+        _render_local.font_config = FontConfiguration()
+        _render_local.full_pdf_css = CSS(string=FULL_PDF_STYLE, font_config=_render_local.font_config)
+    return _render_local.font_config, _render_local.full_pdf_css
+
+# ----------------------
+# Shared PDF render pool, one per server process
+# ----------------------
+# Kept small because uvicorn already runs one server process per CPU
+RENDER_POOL_WORKERS = int(os.environ.get("EDUPATH_RENDER_WORKERS", 2))
+# Batches smaller than this render in-process, where pool start-up would cost more than the PDFs
+RENDER_POOL_MIN_JOBS = 20
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """
+    Return this process's render pool, creating it on first use
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Never fork the multithreaded server process; start workers from a clean interpreter
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_POOL_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _render_pool
+
+def render_in_pool(func, items, chunksize=1):
+    """
+    Map func over items in the render pool, replacing the pool if a worker died
+    """
+    global _render_pool
+    pool = get_render_pool()
+    try:
+        return list(pool.map(func, items, chunksize=chunksize))
+    except BrokenProcessPool:
+        with _render_pool_lock:
+            if _render_pool is pool:
+                _render_pool = None
+        raise
+
+def shutdown_render_pool():
+    """
+    Stop this process's render pool, e.g. when the server shuts down
+    """
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+# ----------------------
+# Columns shown in the allocations table and full PDF
+# ----------------------
+ALLOCATION_COLUMNS = ["Student ID", "Name", "Allocated University", "Allocated Course", "Reasoning"]
+
+def subject_columns(columns):
+    """
+    Return the grade columns, i.e. everything that is not an allocation column
+    """
+    return [c for c in columns if c not in ALLOCATION_COLUMNS]
+
 # ----------------------
 # Allocate students to best-fit courses
 # ----------------------
@@ -26,58 +115,100 @@ def allocate(excel_path, uni_json_path, overrides=None):
     """
     Allocate students to university courses.
     """
-    df = pd.read_excel(excel_path)
-    with open(uni_json_path, "r", encoding="utf-8") as f:
-        universities = json.load(f)
+    # calamine is a Rust-backed reader, much faster than openpyxl's full object model
+    df = pd.read_excel(excel_path, engine="calamine", dtype={"Student ID": str})
+    min_keys, min_labels, uni_names, course_names = load_universities(uni_json_path)
 
-    df["Allocated University"] = ""
-    df["Allocated Course"] = ""
-    df["Reasoning"] = ""
+    overrides = overrides or {}
+    student_ids = df["Student ID"]
+    overridden = student_ids.isin(overrides.keys()).to_numpy()
 
-    for idx, row in df.iterrows():
-        student_id = str(row["Student ID"])
+    # Compute total score for every student in one pass over the subject columns
+    subject_cols = subject_columns(df.columns)
+    codes = np.zeros((len(subject_cols), len(df)), dtype=np.int8)
+    for i, col in enumerate(subject_cols):
+        codes[i] = pd.Categorical(df[col], dtype=GRADE_DTYPE).codes
+    codes[codes < 0] = 0
+    scores = codes.sum(axis=0, dtype=np.int32)
+
+    # Find best-fit course for every student at once
+    uni, course, reason = best_fit_allocation(scores, min_keys, min_labels, uni_names, course_names)
+
+    # Apply overrides where they exist and write all three columns in one go
+    override_uni = student_ids.map({sid: o["university"] for sid, o in overrides.items()}).to_numpy()
+    override_course = student_ids.map({sid: o["course"] for sid, o in overrides.items()}).to_numpy()
+    return df.assign(**{
+        "Allocated University": np.where(overridden, override_uni, uni),
+        "Allocated Course": np.where(overridden, override_course, course),
+        "Reasoning": np.where(overridden, "Manual override applied", reason),
+    })
+
+# ----------------------
+# Load universities, cached until the JSON file changes
+# ----------------------
+def load_universities(uni_json_path):
+    """
+    Load universities.json as sorted course arrays, re-parsing only when the file is modified
+    """
+    return _load_universities(str(uni_json_path), os.stat(uni_json_path).st_mtime_ns)
 
-        # Apply override if exists
-        if overrides and student_id in overrides:
-            df.at[idx, "Allocated University"] = overrides[student_id]["university"]
-            df.at[idx, "Allocated Course"] = overrides[student_id]["course"]
-            df.at[idx, "Reasoning"] = "Manual override applied"
-            continue
+@lru_cache(maxsize=4)
+def _load_universities(path, mtime_ns):
+    with open(path, "r", encoding="utf-8") as f:
+        return flatten_courses(json.load(f))
+
+# ----------------------
+# Flatten universities into sorted course arrays
+# ----------------------
+def flatten_courses(universities):
+    """
+    Flatten universities into parallel (search key, min_score label, university, course) arrays
+    sorted by min_score. Among equal min_scores the course listed first in the JSON sorts last,
+    so it wins ties.
+    """
+    courses = [(uni, course) for uni in universities for course in uni["courses"]]
+    raw_mins = [course.get("min_score", 0) for _, course in courses]
+    for (uni, course), min_score in zip(courses, raw_mins):
+        if isinstance(min_score, bool) or not isinstance(min_score, (int, float)) or not math.isfinite(min_score):
+            raise ValueError(f"min_score for {course.get('name')!r} at {uni.get('name')!r} must be a number, got {min_score!r}")
 
-        # Compute total score
-        total_score = sum(GRADE_TO_SCORE.get(str(row[sub]), 0) for sub in row.index if sub not in ["Student ID", "Name"])
+    # Scores are whole numbers, so searching on the ceiling of each minimum gives the same matches;
+    # the original value is kept for the Reasoning text
+    min_values = np.array(raw_mins, dtype=float)
+    int32 = np.iinfo(np.int32)
+    min_keys = np.clip(np.ceil(min_values), int32.min, int32.max).astype(np.int32)
+    min_labels = np.array([str(min_score) for min_score in raw_mins], dtype=str)
+    uni_names = np.array([uni["name"] for uni, _ in courses], dtype=object)
+    course_names = np.array([course["name"] for _, course in courses], dtype=object)
 
-        # Find best-fit course
-        uni, course, reason = best_fit_allocation(row, universities, total_score)
-        df.at[idx, "Allocated University"] = uni
-        df.at[idx, "Allocated Course"] = course
-        df.at[idx, "Reasoning"] = reason
+    # Sort by the raw min_score (so 10 beats 9.5 even though both search as 10), then by descending JSON position
+    order = np.lexsort((-np.arange(len(courses)), min_values))
+    arrays = tuple(arr[order] for arr in (min_keys, min_labels, uni_names, course_names))
 
-    return df
+    # The arrays are cached by load_universities and shared between requests
+    for arr in arrays:
+        arr.flags.writeable = False
+    return arrays
 
 # ----------------------
 # Best-fit allocation logic
 # ----------------------
-def best_fit_allocation(student_row, universities, total_score):
+def best_fit_allocation(scores, min_keys, min_labels, uni_names, course_names):
     """
-    Find the highest-tier course a student qualifies for across all universities
+    Find the highest-tier course each student qualifies for across all universities
     """
-    best_uni = ""
-    best_course = ""
-    reasoning = "No suitable course found"
+    idx = np.searchsorted(min_keys, scores, side="right") - 1
+    found = idx >= 0
+    if not found.any():
+        none = np.full(len(scores), "", dtype=object)
+        return none, none, np.full(len(scores), "No suitable course found", dtype=object)
 
-    for uni in universities:
-        uni_name = uni["name"]
-        for course in uni["courses"]:
-            min_score = course.get("min_score", 0)
-            if total_score >= min_score:
-                # Pick course with highest min_score <= total_score
-                if not best_course or min_score > next((c["min_score"] for u in universities for c in u["courses"] if c["name"]==best_course), 0):
-                    best_uni = uni_name
-                    best_course = course["name"]
-                    reasoning = f"Total score {total_score} meets minimum {min_score}"
-
-    return best_uni, best_course, reasoning
+    idx = np.where(found, idx, 0)
+    uni = np.where(found, uni_names[idx], "")
+    course = np.where(found, course_names[idx], "")
+    reason = np.char.add(np.char.add("Total score ", scores.astype(str)), np.char.add(" meets minimum ", min_labels[idx]))
+    reason = np.where(found, reason, "No suitable course found")
+    return uni, course, reason
 
 # ----------------------
 # Generate per-student HTML reports
@@ -89,80 +220,140 @@ def generate_reports(df_alloc, report_dir: Path, pdf_dir: Path):
     report_dir.mkdir(exist_ok=True)
     pdf_dir.mkdir(exist_ok=True)
 
-    for idx, row in df_alloc.iterrows():
+    columns = list(df_alloc.columns)
+    subject_cols = subject_columns(columns)
+    jobs = []
+    for values in df_alloc.itertuples(index=False, name=None):
+        row = dict(zip(columns, values))
         student_id = str(row["Student ID"])
-        html_content = f"""
+        jobs.append((student_id, build_report_html(row, subject_cols), report_dir, pdf_dir))
+
+    # PDF rendering is CPU-bound and independent per student, so spread larger batches across processes
+    if len(jobs) < RENDER_POOL_MIN_JOBS:
+        for job in jobs:
+            render_report(job)
+    else:
+        render_in_pool(render_report, jobs, chunksize=8)
+
+# ----------------------
+# Regenerate a single student's report
+# ----------------------
+def generate_report(row, report_dir: Path, pdf_dir: Path):
+    """
+    Generate HTML and PDF report for one student, e.g. after a manual override
+    """
+    student_id = str(row["Student ID"])
+    render_report((student_id, build_report_html(row, subject_columns(row.keys())), report_dir, pdf_dir))
+
+# ----------------------
+# Build one student's report HTML
+# ----------------------
+STUDENT_REPORT_TEMPLATE = Template("""
         <html>
-        <head><title>Report {student_id}</title></head>
+        <head><title>Report {{ student_id }}</title></head>
         <body>
-        <h2>Student Report: {row['Name']} ({student_id})</h2>
+        <h2>Student Report: {{ name }} ({{ student_id }})</h2>
         <table border="1" cellpadding="5" cellspacing="0">
         <tr><th>Subject</th><th>Grade</th></tr>
-        """
-        for col in df_alloc.columns:
-            if col not in ["Student ID", "Name", "Allocated University", "Allocated Course", "Reasoning"]:
-                html_content += f"<tr><td>{col}</td><td>{row[col]}</td></tr>"
-        html_content += f"""
+        {% for subject, grade in subjects %}<tr><td>{{ subject }}</td><td>{{ grade }}</td></tr>{% endfor %}
         </table>
-        <p><b>Allocated University:</b> {row['Allocated University']}</p>
-        <p><b>Allocated Course:</b> {row['Allocated Course']}</p>
-        <p><b>Reasoning:</b> {row['Reasoning']}</p>
+        <p><b>Allocated University:</b> {{ university }}</p>
+        <p><b>Allocated Course:</b> {{ course }}</p>
+        <p><b>Reasoning:</b> {{ reasoning }}</p>
         </body></html>
-        """
+        """)
 
-        html_path = report_dir / f"{student_id}.html"
-        html_path.write_text(html_content, encoding="utf-8")
-
-        pdf_path = pdf_dir / f"{student_id}.pdf"
-        HTML(string=html_content).write_pdf(pdf_path)
+def build_report_html(row, subject_cols):
+    """
+    Build the HTML report for one student row
+    """
+    return STUDENT_REPORT_TEMPLATE.render(
+        student_id=str(row["Student ID"]),
+        name=row["Name"],
+        subjects=[(col, row[col]) for col in subject_cols],
+        university=row["Allocated University"],
+        course=row["Allocated Course"],
+        reasoning=row["Reasoning"],
+    )
 
 # ----------------------
-# Generate full allocations PDF
+# Write one student's HTML and PDF report
 # ----------------------
-def generate_full_pdf(df_alloc, pdf_path: Path):
+def render_report(job):
     """
-    Generate a professional, multi-page PDF for all students
+    Write the HTML and PDF report for a single student (runs in a worker process)
     """
-    html_content = """
-    <html>
-    <head>
-    <style>
+    student_id, html_content, report_dir, pdf_dir = job
+
+    html_path = report_dir / f"{student_id}.html"
+    html_path.write_text(html_content, encoding="utf-8")
+
+    pdf_path = pdf_dir / f"{student_id}.pdf"
+    font_config, _ = render_resources()
+    HTML(string=html_content).write_pdf(pdf_path, font_config=font_config)
+
+# ----------------------
+# Generate full allocations PDF
+# ----------------------
+FULL_PDF_STYLE = """
     body { font-family: Arial, sans-serif; margin: 20px; }
     h1 { text-align: center; }
     table { width: 100%; border-collapse: collapse; margin-bottom: 20px; }
     th, td { border: 1px solid #333; padding: 5px; text-align: center; font-size: 12px; }
     th { background-color: #3498db; color: white; }
-    </style>
-    </head>
+    """
+
+FULL_PDF_TEMPLATE = Template("""
+    <html>
     <body>
-    <h1>Full Student Allocations</h1>
-    <table>
-    <tr>
-        <th>Student ID</th>
-        <th>Name</th>
-        <th>Allocated University</th>
-        <th>Allocated Course</th>
-        <th>Reasoning</th>
-    </tr>
-    """
-
-    for idx, row in df_alloc.iterrows():
-        html_content += f"""
-        <tr>
-            <td>{row['Student ID']}</td>
-            <td>{row['Name']}</td>
-            <td>{row['Allocated University']}</td>
-            <td>{row['Allocated Course']}</td>
-            <td>{row['Reasoning']}</td>
-        </tr>
-        """
-
-    html_content += """
-    </table>
+    {% if show_title %}<h1>Full Student Allocations</h1>{% endif %}
+    {{ table }}
     </body></html>
+    """)
+
+# Cohorts above this size are rendered in chunks and merged, to bound WeasyPrint's memory use
+FULL_PDF_CHUNK_THRESHOLD = 5000
+FULL_PDF_CHUNK_SIZE = 2000
+
+def generate_full_pdf(df_alloc, pdf_path: Path):
+    """
+    Generate a professional, multi-page PDF for all students
+    """
+    if len(df_alloc) <= FULL_PDF_CHUNK_THRESHOLD:
+        font_config, full_pdf_css = render_resources()
+        HTML(string=build_allocations_html(df_alloc)).write_pdf(pdf_path, stylesheets=[full_pdf_css], font_config=font_config)
+        return
+
+    chunks = [
+        build_allocations_html(df_alloc.iloc[start:start + FULL_PDF_CHUNK_SIZE], show_title=(start == 0))
+        for start in range(0, len(df_alloc), FULL_PDF_CHUNK_SIZE)
+    ]
+    pdf_chunks = render_in_pool(render_full_pdf_chunk, chunks)
+
+    writer = PdfWriter()
+    for pdf_bytes in pdf_chunks:
+        writer.append(io.BytesIO(pdf_bytes))
+    writer.write(pdf_path)
+
+# ----------------------
+# Build full allocations HTML
+# ----------------------
+def build_allocations_html(df_alloc, show_title=True):
     """
+    Build the full allocations HTML document for a slice of students
+    """
+    table = df_alloc[ALLOCATION_COLUMNS].to_html(index=False, border=0, classes="alloc")
+    return FULL_PDF_TEMPLATE.render(table=table, show_title=show_title)
 
-    HTML(string=html_content).write_pdf(pdf_path)
+# ----------------------
+# Render one chunk of the full allocations PDF
+# ----------------------
+def render_full_pdf_chunk(html_content):
+    """
+    Render a full allocations HTML chunk to PDF bytes (runs in a worker process)
+    """
+    font_config, full_pdf_css = render_resources()
+    return HTML(string=html_content).write_pdf(stylesheets=[full_pdf_css], font_config=font_config)
 
 # ----------------------
 # NEW: Generate allocations table for HTML injection in browser
@@ -171,10 +362,4 @@ def generate_allocations_table(df_alloc):
     """
     Convert allocations DataFrame to HTML table for immediate browser display
     """
-    html = "<table><tr><th>Student ID</th><th>Name</th><th>Allocated University</th><th>Allocated Course</th><th>Reasoning</th></tr>"
-    for idx, row in df_alloc.iterrows():
-        html += f"<tr><td>{row['Student ID']}</td><td>{row['Name']}</td>"
-        html += f"<td>{row['Allocated University']}</td><td>{row['Allocated Course']}</td>"
-        html += f"<td>{row['Reasoning']}</td></tr>"
-    html += "</table>"
-    return html
+    return df_alloc[ALLOCATION_COLUMNS].to_html(index=False, border=0, classes="alloc")
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import edupath
+
+
+def allocate_scores(universities, scores):
+    min_keys, min_labels, uni_names, course_names = edupath.flatten_courses(universities)
+    uni, course, reason = edupath.best_fit_allocation(np.array(scores), min_keys, min_labels, uni_names, course_names)
+    return list(zip(uni, course, reason))
+
+
+def test_tie_goes_to_first_course_in_json():
+    universities = [
+        {"name": "Juba", "courses": [{"name": "Law", "min_score": 20}]},
+        {"name": "Bahr", "courses": [{"name": "Medicine", "min_score": 20}, {"name": "Arts", "min_score": 20}]},
+    ]
+    assert allocate_scores(universities, [25]) == [("Juba", "Law", "Total score 25 meets minimum 20")]
+
+
+def test_fractional_minimum_is_not_rounded_up():
+    universities = [
+        {"name": "Juba", "courses": [{"name": "Law", "min_score": 10}]},
+        {"name": "Bahr", "courses": [{"name": "Arts", "min_score": 9.5}]},
+    ]
+    assert allocate_scores(universities, [9, 10]) == [
+        ("", "", "No suitable course found"),
+        ("Juba", "Law", "Total score 10 meets minimum 10"),
+    ]
+
+
+def test_score_below_every_minimum():
+    universities = [{"name": "Juba", "courses": [{"name": "Law", "min_score": 20}, {"name": "Arts", "min_score": 10}]}]
+    assert allocate_scores(universities, [5, 15]) == [
+        ("", "", "No suitable course found"),
+        ("Juba", "Arts", "Total score 15 meets minimum 10"),
+    ]
+
+
+def test_no_universities():
+    assert allocate_scores([], [5, 30]) == [
+        ("", "", "No suitable course found"),
+        ("", "", "No suitable course found"),
+    ]
+
+
+@pytest.mark.parametrize("min_score", [None, "20", True, float("nan")])
+def test_non_numeric_min_score_is_rejected(min_score):
+    universities = [{"name": "Juba", "courses": [{"name": "Law", "min_score": min_score}]}]
+    with pytest.raises(ValueError, match="min_score for 'Law' at 'Juba'"):
+        edupath.flatten_courses(universities)